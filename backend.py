@@ -7,16 +7,25 @@ import base64
 from io import BytesIO
 from PIL import Image
 import aiohttp
+from multidict import CIMultiDict
 import asyncio
+import random
+import time
+from collections import deque
 from datetime import datetime
 from typing import Optional
 
-# Token / context sizing
+# Token / context sizing. tiktoken is imported lazily inside _enc_for — most
+# requests stay comfortably under the prompt budget and never need a precise
+# count, so the multi-MB tokenizer import stays off the startup path.
+
+# Fast C JSON decoder for the multi-MB FPL payloads; fall back to aiohttp's
+# default (stdlib json) if orjson is unavailable.
 try:
-    import tiktoken
-    _TIKTOKEN_AVAILABLE = True
+    import orjson
+    _ORJSON_AVAILABLE = True
 except Exception:
-    _TIKTOKEN_AVAILABLE = False
+    _ORJSON_AVAILABLE = False
 
 # --- Configuration ---
 
@@ -48,108 +57,300 @@ def _get_env_var_sanitized(name: str):
 OPENAI_API_KEY = _get_env_var_sanitized("OPENAI_API_KEY")
 GEMINI_API_KEY = _get_env_var_sanitized("GEMINI_API_KEY")
 
+# Presence flags computed once — the provider branches test these on every
+# turn, and a plain bool check is cheaper than re-truth-testing the strings.
+_HAS_OPENAI = bool(OPENAI_API_KEY)
+_HAS_GEMINI = bool(GEMINI_API_KEY)
+
 # --- FPL Data Fetching ---
 
 GITHUB_BASE_URL = "https://arshadfaizan360.github.io/fpl-data-mirror"
 
-async def get_fpl_data():
-    """
-    Fetches FPL data from GitHub mirror (bootstrap, fixtures, live points).
-    Falls back to official API if running locally and mirror is unavailable.
-    """
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-        "Accept": "application/json, text/plain, */*",
-    }
-    
-    connector = aiohttp.TCPConnector(ssl=False)
-
-    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+# Reusable HTTP session so TCP/TLS handshakes are paid once, not per user turn.
+# Created lazily on first fetch; closed via close_fpl_session() on app shutdown.
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+# Built once as a CIMultiDict so aiohttp reuses it directly instead of
+# converting a plain dict on session construction.
+FPL_REQUEST_HEADERS = CIMultiDict({
+    "User-Agent": "Mozilla/5.0",
+    "Accept": "application/json, text/plain, */*",
+})
+
+# Endpoint URLs built once at import rather than re-formatted per fetch.
+_BOOTSTRAP_URL = f"{GITHUB_BASE_URL}/bootstrap-static.json"
+_FIXTURES_URL = f"{GITHUB_BASE_URL}/fixtures.json"
+_LIVE_URL = f"{GITHUB_BASE_URL}/live.json"
+_FIXTURES_CURRENT_URL = f"{GITHUB_BASE_URL}/fixtures-current.json"
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Return the shared aiohttp session, creating it on first use."""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        # limit_per_host lets the gather()ed fetches to the mirror run on
+        # parallel connections instead of serializing behind HTTP/1.1
+        # head-of-line blocking on a single socket.
+        connector = aiohttp.TCPConnector(
+            ssl=False,
+            limit=20,
+            limit_per_host=8,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+        )
+        _SESSION = aiohttp.ClientSession(connector=connector, headers=FPL_REQUEST_HEADERS)
+    return _SESSION
+
+
+async def close_fpl_session():
+    """Close the shared HTTP session (call from the app's shutdown hook)."""
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
+
+# Formatted FPL data is reused across turns within a short TTL window — the
+# underlying feeds only change on a minute/gameweek cadence, so refetching and
+# reformatting megabytes of JSON per user message is wasted work.
+FPL_CACHE_TTL_SECONDS = 30
+_FPL_CACHE = {"data": None, "ts": 0.0}
+# Serializes cache refreshes so a burst of concurrent turns triggers a single
+# mirror fetch instead of a thundering herd.
+_FPL_CACHE_LOCK = asyncio.Lock()
+
+# Per-URL ETag store so refreshes can revalidate against the mirror with
+# If-None-Match and reuse the parsed body on a 304.
+_ETAG_CACHE = {}
+
+# The name/team/position/cost part of each player line only changes when the
+# player list or prices do, so the built prefixes are kept across cache
+# refreshes and only the live suffix (points, form, status) is reformatted.
+_PLAYER_PREFIX_CACHE = {"key": None, "prefixes": None}
+
+# Prompt-context filtering: most questions concern a small slice of the ~700
+# players, so the context embeds only the top scorers plus anyone the query
+# mentions by name. Unavailable players with few points are dropped outright.
+CONTEXT_TOP_PLAYERS = 150
+CONTEXT_MIN_POINTS = 5
+
+
+# Statuses worth retrying: throttling, transient upstream failures, and the
+# occasional 403 the mirror returns under load.
+_RETRYABLE_STATUSES = frozenset((403, 429, 500, 502, 503, 504))
+_FETCH_MAX_ATTEMPTS = 4
+
+
+async def _fetch_json(session: aiohttp.ClientSession, url: str):
+    cached = _ETAG_CACHE.get(url)
+    # The revalidation headers are prepared once per ETag (stored alongside
+    # it) rather than allocated per fetch.
+    headers = cached[2] if cached else None
+    # Retry transient failures per-URL with exponential backoff + jitter, so a
+    # single flaky endpoint doesn't force the gather() to refetch its siblings.
+    for attempt in range(_FETCH_MAX_ATTEMPTS):
         try:
-            # --- Bootstrap (players, teams, events) ---
-            async with session.get(f"{GITHUB_BASE_URL}/bootstrap-static.json") as response:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and cached:
+                    return cached[1]
                 response.raise_for_status()
-                bootstrap_data = await response.json()
+                if _ORJSON_AVAILABLE:
+                    # orjson accepts bytes directly, so read the raw body and skip
+                    # aiohttp's content-type check and charset detection entirely.
+                    data = orjson.loads(await response.read())
+                else:
+                    data = await response.json()
+                etag = response.headers.get("ETag")
+                if etag:
+                    _ETAG_CACHE[url] = (etag, data, CIMultiDict({"If-None-Match": etag}))
+                return data
+        except aiohttp.ClientResponseError as e:
+            if e.status not in _RETRYABLE_STATUSES or attempt == _FETCH_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(0.5 * 2 ** attempt + random.random() * 0.5)
 
-            # --- Fixtures (full season) ---
-            async with session.get(f"{GITHUB_BASE_URL}/fixtures.json") as response:
-                response.raise_for_status()
-                fixtures = await response.json()
 
-            # --- Live points (current GW only) ---
-            async with session.get(f"{GITHUB_BASE_URL}/live.json") as response:
-                response.raise_for_status()
-                live_data = await response.json()
+async def get_fpl_data():
+    """
+    Fetches FPL data from GitHub mirror (bootstrap, fixtures, live points).
+    Falls back to official API if running locally and mirror is unavailable.
 
-            # --- Current GW fixtures ---
-            async with session.get(f"{GITHUB_BASE_URL}/fixtures-current.json") as response:
-                response.raise_for_status()
-                fixtures_current = await response.json()
+    Results are cached in-process for FPL_CACHE_TTL_SECONDS so repeated user
+    turns within the window skip the network and formatting work entirely.
+    """
+    if _FPL_CACHE["data"] is not None and time.monotonic() - _FPL_CACHE["ts"] < FPL_CACHE_TTL_SECONDS:
+        return _FPL_CACHE["data"]
 
-            # Format players data
-            players_info = []
-            for player in bootstrap_data["elements"]:
-                team_name = next((t["name"] for t in bootstrap_data["teams"] if t["id"] == player["team"]), "N/A")
-                position = bootstrap_data["element_types"][player["element_type"] - 1]["singular_name_short"]
+    async with _FPL_CACHE_LOCK:
+        # Re-check under the lock: a concurrent turn may have refreshed the
+        # cache while this one was waiting, in which case reuse its result
+        # instead of hitting the mirror again.
+        now = time.monotonic()
+        if _FPL_CACHE["data"] is not None and now - _FPL_CACHE["ts"] < FPL_CACHE_TTL_SECONDS:
+            return _FPL_CACHE["data"]
 
-                # Always include both season and live points
-                season_points = player["total_points"]
+        session = await _get_session()
 
-                live_points = None
-                if live_data and "elements" in live_data and str(player["id"]) in live_data["elements"]:
-                    live_points = live_data["elements"][str(player["id"])]["stats"]["total_points"]
+        try:
+            # Fetch all four endpoints concurrently — they are independent, so
+            # wall time is roughly the slowest request instead of the sum.
+            bootstrap_data, fixtures, live_data, fixtures_current = await asyncio.gather(
+                _fetch_json(session, _BOOTSTRAP_URL),
+                _fetch_json(session, _FIXTURES_URL),
+                _fetch_json(session, _LIVE_URL),
+                _fetch_json(session, _FIXTURES_CURRENT_URL),
+            )
 
-                players_info.append(
-                    f"- {player['web_name']} ({team_name}, {position}, £{player['now_cost']/10.0}m) - "
-                    f"Season Points: {season_points}, "
-                    f"Live Points: {live_points if live_points is not None else 'N/A'}, "
+            # Index teams/positions once so the loops below do O(1) lookups instead
+            # of scanning the teams list for every player and fixture.
+            team_by_id = {t["id"]: t["name"] for t in bootstrap_data["teams"]}
+            etype_by_id = {et["id"]: et["singular_name_short"] for et in bootstrap_data["element_types"]}
+            live_elements = live_data.get("elements", {}) if live_data else {}
+
+            # Bind loop-invariant references once — the row helpers below run for
+            # every player/fixture, and method/global lookups inside a hot loop
+            # cost a dict probe per iteration that locals avoid.
+            elements = bootstrap_data["elements"]
+            team_get = team_by_id.get
+            etype_get = etype_by_id.get
+            live_get = live_elements.get
+            _str = str
+            NA = "N/A"
+
+            # Reuse the static player-line prefixes when the player list and
+            # prices are unchanged since the previous refresh; the key folds in
+            # the cost sum so price moves invalidate it.
+            prefix_key = (
+                len(elements),
+                elements[0]["id"] if elements else None,
+                elements[-1]["id"] if elements else None,
+                sum(p["now_cost"] for p in elements),
+            )
+            if _PLAYER_PREFIX_CACHE["key"] == prefix_key:
+                prefixes = _PLAYER_PREFIX_CACHE["prefixes"]
+            else:
+                prefixes = [
+                    f"- {p['web_name']} ({team_get(p['team'], NA)}, "
+                    f"{etype_get(p['element_type'], NA)}, £{p['now_cost'] / 10.0}m) - "
+                    for p in elements
+                ]
+                _PLAYER_PREFIX_CACHE["key"] = prefix_key
+                _PLAYER_PREFIX_CACHE["prefixes"] = prefixes
+
+            # Format the sections via generator expressions fed straight into
+            # "\n".join — no intermediate lists of per-row strings are built.
+            def _player_line(prefix, player):
+                live_entry = live_get(_str(player["id"]))
+                live_points = live_entry["stats"]["total_points"] if live_entry else None
+                return (
+                    f"{prefix}"
+                    f"Season Points: {player['total_points']}, "
+                    f"Live Points: {live_points if live_points is not None else NA}, "
                     f"Form: {player['form']}, "
                     f"Status: {player['status']}"
                 )
 
-            # Format fixtures data (upcoming season fixtures)
-            fixtures_info = []
-            for fixture in fixtures:
-                home_team = next((t["name"] for t in bootstrap_data["teams"] if t["id"] == fixture["team_h"]), "N/A")
-                away_team = next((t["name"] for t in bootstrap_data["teams"] if t["id"] == fixture["team_a"]), "N/A")
-                fixtures_info.append(f"- GW {fixture['event']}: {home_team} vs {away_team}")
-
-            # Format current GW fixtures with consistent live scores
-            fixtures_current_info = []
-            for fixture in fixtures_current:
-                home_team = next((t["name"] for t in bootstrap_data["teams"] if t["id"] == fixture["team_h"]), "N/A")
-                away_team = next((t["name"] for t in bootstrap_data["teams"] if t["id"] == fixture["team_a"]), "N/A")
-
-                # Determine live score or placeholder
+            def _current_fixture_line(fixture):
                 home_score = fixture.get("team_h_score")
                 away_score = fixture.get("team_a_score")
                 if home_score is not None and away_score is not None:
                     score_str = f"{home_score} - {away_score}"
                 else:
                     score_str = "Not started"
-
-                fixtures_current_info.append(
-                    f"- GW {fixture['event']}: {home_team} {score_str} {away_team}"
+                return (
+                    f"- GW {fixture['event']}: {team_get(fixture['team_h'], NA)} "
+                    f"{score_str} {team_get(fixture['team_a'], NA)}"
                 )
 
+            player_lines = list(map(_player_line, prefixes, elements))
+            players_text = "\n".join(player_lines)
+
+            # Select the context slice: skip unavailable low-scorers, then keep
+            # the top scorers. The full per-name line map is kept alongside so
+            # get_chatbot_advice can re-add players a question mentions.
+            ranked = sorted(
+                (
+                    i for i, p in enumerate(elements)
+                    if not (p["status"] in ("u", "n") and p["total_points"] < CONTEXT_MIN_POINTS)
+                ),
+                key=lambda i: elements[i]["total_points"],
+                reverse=True,
+            )[:CONTEXT_TOP_PLAYERS]
+            ranked.sort()  # keep the original bootstrap ordering in the prompt
+            players_context_text = "\n".join(player_lines[i] for i in ranked)
+            context_names = frozenset(elements[i]["web_name"].lower() for i in ranked)
+            lines_by_name = {
+                p["web_name"].lower(): line for p, line in zip(elements, player_lines)
+            }
+
+            fixtures_text = "\n".join(
+                f"- GW {f['event']}: {team_get(f['team_h'], NA)} vs {team_get(f['team_a'], NA)}"
+                for f in fixtures
+            )
+
+            fixtures_current_text = "\n".join(_current_fixture_line(f) for f in fixtures_current)
+
             # Get current gameweek
             current_gameweek = next((event["id"] for event in bootstrap_data["events"] if event["is_current"]), "N/A")
 
-            return {
-                "players": "\n".join(players_info),
-                "fixtures": "\n".join(fixtures_info),
-                "fixtures_current": "\n".join(fixtures_current_info),
+            result = {
+                "players": players_text,
+                "players_context": players_context_text,
+                "player_lines": lines_by_name,
+                "context_names": context_names,
+                "fixtures": fixtures_text,
+                "fixtures_current": fixtures_current_text,
                 "current_gameweek": current_gameweek,
                 "current_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
+            # Pre-assemble the prompt data context once per refresh; every turn
+            # in the TTL window reuses it instead of re-concatenating ~100KB.
+            result["data_context"] = _build_data_context(result)
+            _FPL_CACHE["data"] = result
+            _FPL_CACHE["ts"] = now
+            return result
 
         except Exception as e:
             return {"error": f"Error fetching FPL data: {e}"}
 
 # --- AI Interaction ---
 
+# One OpenAI client per process — each construction brings its own HTTP
+# connection pool, so a shared instance keeps provider connections warm
+# across turns instead of paying a TLS handshake per call.
+_OPENAI_CLIENT: Optional[OpenAI] = None
+
+
+def _openai_client() -> OpenAI:
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None:
+        _OPENAI_CLIENT = OpenAI(api_key=OPENAI_API_KEY, max_retries=1)
+    return _OPENAI_CLIENT
+
+
+# Configure Gemini once at import; per-call genai.configure re-does transport setup.
+if _HAS_GEMINI:
+    try:
+        genai.configure(api_key=GEMINI_API_KEY)
+    except Exception:
+        pass
+
+# Matching singleton for the Gemini model handle — GenerativeModel construction
+# rebuilds config and transport state, so share one across calls.
+_GEMINI_MODEL = None
+
+
+def _gemini_model():
+    global _GEMINI_MODEL
+    if _GEMINI_MODEL is None:
+        _GEMINI_MODEL = genai.GenerativeModel('gemini-1.5-flash')
+    return _GEMINI_MODEL
+
 # Simple in-memory session store for conversation history.
-# Keys are session_id strings, values are lists of {"role": "user|assistant", "content": str}.
+# Keys are session_id strings, values are deques of {"role": "user|assistant", "content": str}.
+# The deque maxlen enforces the per-session cap automatically, and popleft()
+# during trimming is O(1) instead of list.pop(0)'s O(N) shift.
 SESSION_HISTORY = {}
 # Maximum number of messages to keep per session (user+assistant entries count individually).
 SESSION_HISTORY_MAX = 12
@@ -163,19 +364,70 @@ PROMPT_TRUNCATE_PLAYERS_CHARS = 3000
 PROMPT_TRUNCATE_FIXTURES_CHARS = 2000
 
 
-def estimate_tokens(text: str, model_name: str = 'gpt-4o') -> int:
-    """Estimate token count for a given text. Uses tiktoken if available, else a heuristic."""
-    if not text:
-        return 0
-    if _TIKTOKEN_AVAILABLE:
+# Resolved tiktoken encoders, keyed by model name. Resolving an encoding is
+# expensive (table loads), so do it once per model and reuse. The import
+# itself is memoized: one failure marks tiktoken unavailable for the process.
+_ENC_CACHE = {}
+_TIKTOKEN_UNAVAILABLE = False
+
+
+def _enc_for(model_name: str):
+    """Return a cached tiktoken encoding for the model, or None if unavailable."""
+    global _TIKTOKEN_UNAVAILABLE
+    enc = _ENC_CACHE.get(model_name)
+    if enc is None and not _TIKTOKEN_UNAVAILABLE:
+        try:
+            import tiktoken
+        except Exception:
+            _TIKTOKEN_UNAVAILABLE = True
+            return None
         try:
             # choose encoding by model when possible
             enc = tiktoken.encoding_for_model(model_name)
         except Exception:
             enc = tiktoken.get_encoding("cl100k_base")
-        return len(enc.encode(text))
-    # fallback heuristic: average 4 chars per token
-    return max(1, int(len(text) / 4))
+        _ENC_CACHE[model_name] = enc
+    return enc
+
+
+def estimate_tokens(text: str, model_name: str = 'gpt-4o', precise: bool = False) -> int:
+    """Estimate token count for a given text.
+
+    The ~4 chars/token heuristic is the default answer; the real tokenizer is
+    only consulted when the caller asks for precision or the cheap estimate
+    lands within 10% of MAX_PROMPT_TOKENS, where the heuristic's error could
+    flip a truncation decision.
+    """
+    if not text:
+        return 0
+    approx = max(1, len(text) >> 2)
+    if not precise and abs(approx - MAX_PROMPT_TOKENS) > MAX_PROMPT_TOKENS * 0.1:
+        return approx
+    enc = _enc_for(model_name)
+    if enc is None:
+        return approx
+    # encode_ordinary skips the special-token regex scan, which raw prompt
+    # text never needs.
+    return len(enc.encode_ordinary(text))
+
+
+def estimate_tokens_many(texts, model_name: str = 'gpt-4o') -> list:
+    """Estimate token counts for several texts at once.
+
+    With tiktoken available this uses encode_ordinary_batch, which runs the
+    encodes on the tokenizer's internal thread pool and pays the Python<->Rust
+    crossing once for the whole batch instead of per text.
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    enc = _enc_for(model_name)
+    if enc is not None:
+        try:
+            return [len(ids) for ids in enc.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 4)]
+        except Exception:
+            pass
+    return [max(1, len(t) >> 2) if t else 0 for t in texts]
 
 
 def compress_image_data_url(image_data_url: str, max_bytes: int = IMAGE_MAX_BYTES) -> Optional[str]:
@@ -185,38 +437,68 @@ def compress_image_data_url(image_data_url: str, max_bytes: int = IMAGE_MAX_BYTE
     if not image_data_url or not image_data_url.startswith('data:'):
         return None
     try:
-        header, encoded = image_data_url.split(',', 1)
+        # partition avoids the list allocation that split(',', 1) makes
+        header, _, encoded = image_data_url.partition(',')
         data = base64.b64decode(encoded)
         if len(data) <= max_bytes:
             return image_data_url
 
-        img = Image.open(BytesIO(data)).convert('RGB')
-
-        # iterative downscale + quality reduction
-        quality = 85
-        width, height = img.size
-        # reduce until small enough or until dimensions/quality are low
-        for scale in (0.9, 0.8, 0.7, 0.6, 0.5, 0.4):
-            new_size = (max(200, int(width * scale)), max(200, int(height * scale)))
-            img_resized = img.resize(new_size, Image.LANCZOS)
-            buf = BytesIO()
-            img_resized.save(buf, format='JPEG', quality=quality)
-            b = buf.getvalue()
-            if len(b) <= max_bytes:
-                new_encoded = base64.b64encode(b).decode('ascii')
-                mime = 'image/jpeg'
-                return f"data:{mime};base64,{new_encoded}"
-            # progressively reduce quality
-            quality = max(30, quality - 15)
+        img = Image.open(BytesIO(data))
+        if img.mode not in ("RGB", "L"):
+            # only pay the full-pixel-buffer copy when the source actually
+            # needs converting; JPEG handles RGB and L natively
+            img = img.convert("RGB")
+
+        # single output buffer reused across attempts to avoid repeat allocations
+        buf = BytesIO()
+
+        def _encode(image, q):
+            buf.seek(0)
+            buf.truncate()
+            # optimize/progressive cost extra CPU for marginal size savings —
+            # skip them for interactive compression; 4:2:0 subsampling halves
+            # chroma data, which both speeds the encode and shrinks the output
+            image.save(buf, format='JPEG', quality=q, subsampling=2, optimize=False, progressive=False)
+            return buf.getvalue()
+
+        # JPEG size is roughly monotonic in quality at a fixed resolution, so
+        # binary-search quality at native resolution instead of re-encoding at
+        # six fixed scales — typically 2-4 encodes instead of up to 7.
+        b = _encode(img, 85)
+        if len(b) > max_bytes:
+            lo, hi = 30, 84
+            best = None
+            for _ in range(4):
+                mid = (lo + hi) // 2
+                b = _encode(img, mid)
+                if len(b) <= max_bytes:
+                    best = b
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+                if lo > hi:
+                    break
+            if best is not None:
+                b = best
+            elif len(b) > max_bytes:
+                # still too big at low quality: one downscale sized from the
+                # overshoot ratio, then a final encode
+                scale = (max_bytes / len(b)) ** 0.5
+                new_size = (max(200, int(img.width * scale)), max(200, int(img.height * scale)))
+                b = _encode(img.resize(new_size, Image.LANCZOS), 70)
+        if len(b) <= max_bytes:
+            # join bytes once rather than bytes -> str -> f-string, which would
+            # carry three copies of a ~200 kB payload at peak
+            return b''.join((b"data:image/jpeg;base64,", base64.b64encode(b))).decode('ascii')
 
         # final fallback: aggressively thumbnail
         img.thumbnail((400, 400), Image.LANCZOS)
-        buf = BytesIO()
-        img.save(buf, format='JPEG', quality=40)
+        buf.seek(0)
+        buf.truncate()
+        img.save(buf, format='JPEG', quality=40, subsampling=2, optimize=False, progressive=False)
         b = buf.getvalue()
         if len(b) <= max_bytes:
-            new_encoded = base64.b64encode(b).decode('ascii')
-            return f"data:image/jpeg;base64,{new_encoded}"
+            return b''.join((b"data:image/jpeg;base64,", base64.b64encode(b))).decode('ascii')
         # give up
         return None
     except Exception:
@@ -226,6 +508,9 @@ def compress_image_data_url(image_data_url: str, max_bytes: int = IMAGE_MAX_BYTE
 def truncate_fpl_sections(fpl_data: dict, players_chars: int = PROMPT_TRUNCATE_PLAYERS_CHARS, fixtures_chars: int = PROMPT_TRUNCATE_FIXTURES_CHARS) -> dict:
     """Return a shallow copy of fpl_data where long text sections are truncated for prompt size safety."""
     fd = fpl_data.copy()
+    # The pre-built context reflects the untruncated sections; drop it so
+    # callers rebuild from the shortened ones.
+    fd.pop('data_context', None)
     try:
         if 'players' in fd and fd['players'] and len(fd['players']) > players_chars:
             fd['players'] = fd['players'][:players_chars] + "\n... (players list truncated for prompt size)"
@@ -238,10 +523,32 @@ def truncate_fpl_sections(fpl_data: dict, players_chars: int = PROMPT_TRUNCATE_P
     return fd
 
 
-def trim_history_to_fit(session_id: str, base_prompt: str, max_tokens: int = MAX_PROMPT_TOKENS, model_name: str = 'gpt-4o') -> None:
+def _entry_tokens(entry: dict, model_name: str = 'gpt-4o') -> int:
+    """Token count of one history entry as it appears in the conversation log."""
+    role = entry.get('role', '')
+    content = entry.get('content', '')
+    return estimate_tokens(f"{role.capitalize()}: {content}", model_name=model_name)
+
+
+def append_history(session_id: str, role: str, content: str, model_name: str = 'gpt-4o') -> None:
+    """Append a message to the session history, recording its token count once.
+
+    Storing the count at append time lets trim_history_to_fit maintain a
+    running sum instead of re-tokenizing the whole conversation per trim step.
+    """
+    entry = {"role": role, "content": content}
+    entry["tokens"] = _entry_tokens(entry, model_name=model_name)
+    SESSION_HISTORY.setdefault(session_id, deque(maxlen=SESSION_HISTORY_MAX)).append(entry)
+
+
+def trim_history_to_fit(session_id: str, base_prompt: str, max_tokens: int = MAX_PROMPT_TOKENS, model_name: str = 'gpt-4o', base_tokens: int = None) -> None:
     """Trim oldest messages from session history until the combined tokens of history + base_prompt fit within max_tokens.
 
     This function mutates SESSION_HISTORY[session_id] in place (removing oldest entries first).
+
+    Pass ``base_tokens`` (the precomputed count for base_prompt) when calling
+    more than once per turn, so the multi-hundred-KB prompt is encoded once
+    rather than per call.
     """
     if not session_id:
         return
@@ -249,94 +556,117 @@ def trim_history_to_fit(session_id: str, base_prompt: str, max_tokens: int = MAX
     if not history:
         return
 
-    # Build conversation text similar to _prepend_history_to_prompt
-    def build_convo_text(entries):
-        lines = ["Conversation so far:"]
-        for e in entries:
-            role = e.get('role', '')
-            content = e.get('content', '')
-            lines.append(f"{role.capitalize()}: {content}")
-        return "\n".join(lines)
-
-    # Current history + base prompt token estimate
-    entries = history.copy()
-    while True:
-        convo_text = build_convo_text(entries)
-        combined = convo_text + "\n\n" + (base_prompt or "")
-        tokens = estimate_tokens(combined, model_name=model_name)
-        if tokens <= max_tokens:
-            break
-        # if nothing to remove, break to avoid infinite loop
-        if not entries:
-            break
-        # remove the oldest message and try again
-        entries.pop(0)
-
-    # Assign trimmed entries back to the session
-    SESSION_HISTORY[session_id] = entries
+    # Fixed costs: the base prompt plus the "Conversation so far:" header and
+    # joining newlines. Per-entry counts were recorded at append time, so each
+    # trim step is a subtraction rather than a full re-encode.
+    if base_tokens is None:
+        base_tokens = estimate_tokens(base_prompt, model_name=model_name)
+    base_tokens += estimate_tokens("Conversation so far:\n\n", model_name=model_name)
+
+    # Backfill counts for any entries written before counts were recorded,
+    # in a single batched tokenizer call.
+    missing = [e for e in history if not e.get("tokens")]
+    if missing:
+        counts = estimate_tokens_many(
+            (f"{e.get('role', '').capitalize()}: {e.get('content', '')}" for e in missing),
+            model_name=model_name,
+        )
+        for entry, count in zip(missing, counts):
+            entry["tokens"] = count
+
+    total = sum(e["tokens"] for e in history)
+    while history and total + base_tokens > max_tokens:
+        total -= history.popleft()["tokens"]
+
+# Race OpenAI and Gemini on image requests when both are configured. Costs an
+# extra provider call per request but returns whichever answers first.
+RACE_PROVIDERS = False
+
+
+async def _openai_image_call(prompt, send_image):
+    """Single structured multimodal Responses API call (SDK runs in a thread)."""
+    client = _openai_client()
+    # Use the structured multimodal input shape: an array of content blocks
+    # (input_text + input_image with base64 data URL).
+    structured_content = [
+        {"type": "input_text", "text": prompt},
+        {"type": "input_image", "image_url": send_image},
+    ]
+    response = await asyncio.to_thread(
+        client.responses.create,
+        model="gpt-5-mini",
+        input=[{"role": "user", "content": structured_content}]
+    )
+    out = getattr(response, 'output_text', None)
+    if out:
+        return out
+    try:
+        return response.output[0].content[0].text
+    except Exception:
+        return str(response)
+
+
+def _decode_image_for_gemini(image_data_url):
+    """Decode a data URL into a PIL image, downscaled for upload.
+
+    Runs in a worker thread: b64decode + the actual pixel decode (forced via
+    load()) would otherwise block the event loop for every screenshot upload.
+    """
+    header, encoded = image_data_url.split(",", 1)
+    image = Image.open(BytesIO(base64.b64decode(encoded)))
+    image.load()
+    # Screenshots larger than ~1280px gain nothing for vision models; shrinking
+    # here cuts upload bytes and the provider's vision token cost.
+    if image.width > 1280 or image.height > 1280:
+        image.thumbnail((1280, 1280), Image.LANCZOS)
+    return image
+
+
+async def _gemini_image_call(prompt, image_data_url):
+    """Single Gemini multimodal call."""
+    image = await asyncio.to_thread(_decode_image_for_gemini, image_data_url)
+    response = await _gemini_model().generate_content_async([prompt, image])
+    return response.text
+
 
 async def get_ai_response_with_image(prompt, image_data_url):
+    # Compress the image exactly once (avoid context-length errors); every
+    # provider attempt below reuses the result instead of re-running Pillow.
+    compressed = await asyncio.to_thread(compress_image_data_url, image_data_url)
+    send_image = compressed if compressed is not None else image_data_url
+
+    # Optionally race both providers and take the first non-error result.
+    if RACE_PROVIDERS and AI_PROVIDER == "OPENAI" and _HAS_OPENAI and _HAS_GEMINI:
+        pending = {
+            asyncio.create_task(_openai_image_call(prompt, send_image)),
+            asyncio.create_task(_gemini_image_call(prompt, image_data_url)),
+        }
+        errors = []
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    return task.result()
+                errors.append(task.exception())
+        return " | ".join(f"Provider error: {e}" for e in errors)
+
     # Try OpenAI multimodal with GPT-5 mini first when provider is OPENAI
     openai_err = None
     if AI_PROVIDER == "OPENAI":
-        if not OPENAI_API_KEY:
+        if not _HAS_OPENAI:
             return "Error: OPENAI_API_KEY environment variable not set."
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        # Try structured multimodal Responses API using the official SDK shape
         try:
             try:
-                # compress the image data URI if it's too large (avoid context-length errors)
-                compressed = compress_image_data_url(image_data_url)
-                send_image = compressed if compressed is not None else image_data_url
-
-                # run blocking SDK call in a thread to keep this function async
-                # Use the structured multimodal input shape: an array of content blocks
-                # (input_text + input_image with base64 data URL) as shown in the user's example.
-                structured_content = [
-                    {"type": "input_text", "text": prompt},
-                    {"type": "input_image", "image_url": send_image},
-                ]
-                response = await asyncio.to_thread(
-                    client.responses.create,
-                    model="gpt-5-mini",
-                    input=[{"role": "user", "content": structured_content}]
-                )
-                out = getattr(response, 'output_text', None)
-                if out:
-                    return out
-                try:
-                    return response.output[0].content[0].text
-                except Exception:
-                    return str(response)
-                out = getattr(response, 'output_text', None)
-                if out:
-                    return out
-                try:
-                    return response.output[0].content[0].text
-                except Exception:
-                    return str(response)
+                return await _openai_image_call(prompt, send_image)
             except Exception as e:
                 openai_err = e
-                # Fallback: embed a compressed or placeholder data URI into the prompt and try text-only call
+                # Fallback: retry with the already-compressed data URI, or drop
+                # the image and do a text-only call when compression failed.
                 try:
-                    compressed = compress_image_data_url(image_data_url)
                     if compressed:
-                        structured_content = [
-                            {"type": "input_text", "text": prompt},
-                            {"type": "input_image", "image_url": compressed},
-                        ]
-                        resp = await asyncio.to_thread(
-                            client.responses.create,
-                            model="gpt-5-mini",
-                            input=[{"role": "user", "content": structured_content}]
-                        )
-                        out = getattr(resp, 'output_text', None)
-                        if out:
-                            return out
-                        try:
-                            return resp.output[0].content[0].text
-                        except Exception:
-                            return str(resp)
+                        return await _openai_image_call(prompt, compressed)
                     else:
                         # if we couldn't compress efficiently, include a short placeholder and ask user to upload a smaller image
                         fallback_prompt = prompt + "\n\n[Image omitted from prompt because it was too large to include. Please crop or upload a smaller image if more detailed analysis is required.]"
@@ -349,16 +679,9 @@ async def get_ai_response_with_image(prompt, image_data_url):
             openai_err = e
 
     # If Gemini is configured (or OpenAI failed), try Gemini multimodal
-    if GEMINI_API_KEY:
+    if _HAS_GEMINI:
         try:
-            genai.configure(api_key=GEMINI_API_KEY)
-            header, encoded = image_data_url.split(",", 1)
-            image_data = base64.b64decode(encoded)
-            image = Image.open(BytesIO(image_data))
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            content = [prompt, image]
-            response = await model.generate_content_async(content)
-            return response.text
+            return await _gemini_image_call(prompt, image_data_url)
         except Exception as e:
             if openai_err:
                 return f"OpenAI error: {openai_err} | Gemini error: {e}"
@@ -373,10 +696,10 @@ async def get_ai_response_with_image(prompt, image_data_url):
 async def get_ai_response_text_only(prompt):
     # ... (rest of the function remains the same)
     if AI_PROVIDER == "OPENAI":
-        if not OPENAI_API_KEY:
+        if not _HAS_OPENAI:
             return "Error: OPENAI_API_KEY environment variable not set."
         try:
-            client = OpenAI(api_key=OPENAI_API_KEY)
+            client = _openai_client()
             # Use the Responses API via a thread to avoid blocking the event loop
             try:
                 response = await asyncio.to_thread(
@@ -396,12 +719,10 @@ async def get_ai_response_text_only(prompt):
         except OpenAIError:
             return "Error: Invalid OpenAI API key."
     elif AI_PROVIDER == "GEMINI":
-        if not GEMINI_API_KEY:
+        if not _HAS_GEMINI:
             return "Error: GEMINI_API_KEY environment variable not set."
         try:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = await model.generate_content_async(prompt)
+            response = await _gemini_model().generate_content_async(prompt)
             return response.text
         except Exception as e:
             return f"Error with Gemini: {e}"
@@ -429,6 +750,47 @@ def _prepend_history_to_prompt(base_prompt, session_id: str):
 
 # --- Main Chatbot Logic ---
 
+# Static prompt blocks, built once at import. The per-turn prompt is assembled
+# with a single join so the (potentially huge) data context is never copied
+# through intermediate f-strings.
+_PROMPT_HEADER = (
+    "You are a friendly and knowledgeable FPL AI assistant. "
+    "Your tone is conversational and you use British English."
+)
+
+_IMAGE_INSTRUCTIONS = (
+    "**User's Request:**\n"
+    "The user has uploaded a screenshot of their team and asked a question.\n\n"
+    "**IMPORTANT INSTRUCTIONS FOR IMAGE ANALYSIS:**\n"
+    "1. Identify the players in the user's squad from the screenshot.\n"
+    "2. A player's actual team is shown by their jersey. "
+    "The team name underneath them is their **next opponent**. Do not confuse the two.\n"
+    "3. Use both **season stats** and **live points / live scores** to inform your advice.\n"
+    "4. When recommending transfers, captains, or lineup changes, consider both historical performance (season points, form) and current matchday performance (live points, live scores) where available.\n\n"
+    "Provide a helpful, conversational response to the user's question."
+)
+
+_TEXT_INSTRUCTIONS = (
+    "**User's Request:**\n"
+    "The user has asked a general question about FPL.\n\n"
+    "**IMPORTANT INSTRUCTIONS:**\n"
+    "1. Use both **season stats** and **live points / live scores** when reasoning.\n"
+    "2. Give advice considering both historical performance (season points, form) and current matchday performance (live points, live scores) where available.\n"
+    "3. Be conversational, clear, and precise. Use British English."
+)
+
+def _build_data_context(d):
+    """Assemble the prompt data-context block from a formatted FPL data dict."""
+    players = d.get('players_context') or d['players']
+    return (
+        f"Current Date: {d['current_date']}\n"
+        f"Current Gameweek: {d['current_gameweek']}\n\n"
+        f"**Available Players & Stats (Season + Live):**\n{players}\n\n"
+        f"**Upcoming Fixtures (Season):**\n{d['fixtures']}\n\n"
+        f"**Current Gameweek Fixtures (Live Scores if available):**\n{d['fixtures_current']}"
+    )
+
+
 async def get_chatbot_advice(user_query, image_data_url=None, session_id: str = None):
     """
     Main function to get FPL advice, now with full live and season data context.
@@ -438,58 +800,60 @@ async def get_chatbot_advice(user_query, image_data_url=None, session_id: str =
         return fpl_data["error"]
 
     # --- Build context for the AI ---
-    data_context = (
-        f"Current Date: {fpl_data['current_date']}\n"
-        f"Current Gameweek: {fpl_data['current_gameweek']}\n\n"
-        f"**Available Players & Stats (Season + Live):**\n{fpl_data['players']}\n\n"
-        f"**Upcoming Fixtures (Season):**\n{fpl_data['fixtures']}\n\n"
-        f"**Current Gameweek Fixtures (Live Scores if available):**\n{fpl_data['fixtures_current']}"
-    )
+    # Reuse the context assembled at cache-refresh time when present.
+    data_context = fpl_data.get("data_context") or _build_data_context(fpl_data)
+
+    # Re-add players the question mentions by name but the top-scorer filter
+    # dropped, so "should I buy X" still sees X's line.
+    lines_by_name = fpl_data.get("player_lines")
+    if lines_by_name:
+        query_lower = user_query.lower()
+        in_context = fpl_data.get("context_names") or frozenset()
+        mentioned = [
+            line for name, line in lines_by_name.items()
+            if name not in in_context and name in query_lower
+        ]
+        if mentioned:
+            data_context = "{}\n\n**Players mentioned in the question:**\n{}".format(
+                data_context, "\n".join(mentioned)
+            )
 
     # If the combined prompt is very large, truncate large FPL sections to keep under token limits
     try:
-        preview_prompt = f"You are a friendly and knowledgeable FPL AI assistant.\n\n**FPL Data Context:**\n{data_context}\n\nUser's question: \"{user_query}\""
-        if estimate_tokens(preview_prompt) > MAX_PROMPT_TOKENS:
+        # First-stage sizing via the ~4 chars/token heuristic: skip the real
+        # tokenizer entirely when the cheap bound is clearly under or clearly
+        # over budget, and only tokenize in the narrow band in between.
+        approx_tokens = (len(data_context) + len(user_query) + 400) >> 2
+        if approx_tokens < MAX_PROMPT_TOKENS * 0.8:
+            needs_truncate = False
+        elif approx_tokens > MAX_PROMPT_TOKENS * 1.2:
+            needs_truncate = True
+        else:
+            preview_prompt = f"You are a friendly and knowledgeable FPL AI assistant.\n\n**FPL Data Context:**\n{data_context}\n\nUser's question: \"{user_query}\""
+            needs_truncate = estimate_tokens(preview_prompt, precise=True) > MAX_PROMPT_TOKENS
+        if needs_truncate:
             # create a truncated copy of fpl_data and rebuild the data_context
             small = truncate_fpl_sections(fpl_data)
-            data_context = (
-                f"Current Date: {small['current_date']}\n"
-                f"Current Gameweek: {small['current_gameweek']}\n\n"
-                f"**Available Players & Stats (Season + Live):**\n{small['players']}\n\n"
-                f"**Upcoming Fixtures (Season):**\n{small['fixtures']}\n\n"
-                f"**Current Gameweek Fixtures (Live Scores if available):**\n{small['fixtures_current']}"
-            )
+            data_context = _build_data_context(small)
     except Exception:
         # best-effort: if anything goes wrong here, continue with original context
         pass
 
     if image_data_url:
-        prompt = f"""
-        You are a friendly and knowledgeable FPL AI assistant. 
-        Your tone is conversational and you use British English.
-
-        **FPL Data Context:**
-        {data_context}
-
-        **User's Request:**
-        The user has uploaded a screenshot of their team and asked a question.
-
-        **IMPORTANT INSTRUCTIONS FOR IMAGE ANALYSIS:**
-        1. Identify the players in the user's squad from the screenshot.
-        2. A player's actual team is shown by their jersey. 
-           The team name underneath them is their **next opponent**. Do not confuse the two.
-        3. Use both **season stats** and **live points / live scores** to inform your advice.
-        4. When recommending transfers, captains, or lineup changes, consider both historical performance (season points, form) and current matchday performance (live points, live scores) where available.
-
-        Provide a helpful, conversational response to the user's question.
-
-        User's question: "{user_query}"
-        """
+        prompt = "\n\n".join((
+            _PROMPT_HEADER,
+            "**FPL Data Context:**",
+            data_context,
+            _IMAGE_INSTRUCTIONS,
+            f'User\'s question: "{user_query}"',
+        ))
         # append the user's message to history before calling the model
+        base_tokens = None
         if session_id:
-            SESSION_HISTORY.setdefault(session_id, []).append({"role": "user", "content": user_query})
-            # ensure history fits token budget
-            trim_history_to_fit(session_id, prompt)
+            append_history(session_id, "user", user_query)
+            # encode the base prompt once; both trims this turn reuse the count
+            base_tokens = estimate_tokens(prompt)
+            trim_history_to_fit(session_id, prompt, base_tokens=base_tokens)
 
         # include recent conversation history in prompt (after trimming)
         full_prompt = _prepend_history_to_prompt(prompt, session_id)
@@ -498,35 +862,27 @@ async def get_chatbot_advice(user_query, image_data_url=None, session_id: str =
 
         # store assistant reply
         if session_id:
-            SESSION_HISTORY.setdefault(session_id, []).append({"role": "assistant", "content": response_text})
+            append_history(session_id, "assistant", response_text)
             # ensure history still fits budget after appending reply
-            trim_history_to_fit(session_id, prompt)
+            trim_history_to_fit(session_id, prompt, base_tokens=base_tokens)
 
         return response_text
 
     else:
-        prompt = f"""
-        You are a friendly and knowledgeable FPL AI assistant. 
-        Your tone is conversational and you use British English.
-
-        **FPL Data Context:**
-        {data_context}
-
-        **User's Request:**
-        The user has asked a general question about FPL.
-
-        **IMPORTANT INSTRUCTIONS:**
-        1. Use both **season stats** and **live points / live scores** when reasoning.
-        2. Give advice considering both historical performance (season points, form) and current matchday performance (live points, live scores) where available.
-        3. Be conversational, clear, and precise. Use British English.
-
-        User's question: "{user_query}"
-        """
+        prompt = "\n\n".join((
+            _PROMPT_HEADER,
+            "**FPL Data Context:**",
+            data_context,
+            _TEXT_INSTRUCTIONS,
+            f'User\'s question: "{user_query}"',
+        ))
         # append the user's message to history before calling the model
+        base_tokens = None
         if session_id:
-            SESSION_HISTORY.setdefault(session_id, []).append({"role": "user", "content": user_query})
-            # ensure history fits token budget
-            trim_history_to_fit(session_id, prompt)
+            append_history(session_id, "user", user_query)
+            # encode the base prompt once; both trims this turn reuse the count
+            base_tokens = estimate_tokens(prompt)
+            trim_history_to_fit(session_id, prompt, base_tokens=base_tokens)
 
         # include recent conversation history in prompt (after trimming)
         full_prompt = _prepend_history_to_prompt(prompt, session_id)
@@ -534,13 +890,34 @@ async def get_chatbot_advice(user_query, image_data_url=None, session_id: str =
         response_text = await get_ai_response_text_only(full_prompt)
 
         if session_id:
-            SESSION_HISTORY.setdefault(session_id, []).append({"role": "assistant", "content": response_text})
+            append_history(session_id, "assistant", response_text)
             # ensure history still fits budget after appending reply
-            trim_history_to_fit(session_id, prompt)
+            trim_history_to_fit(session_id, prompt, base_tokens=base_tokens)
 
         return response_text
 
 
+# Cap on concurrent provider calls from the batch helper — enough overlap to
+# hide network waits without tripping provider rate limits.
+_BATCH_CONCURRENCY = 20
+
+
+async def get_chatbot_advice_batch(queries, session_id: str = None):
+    """Answer many queries concurrently, sharing one cached FPL data fetch.
+
+    ``queries`` is a list of (user_query, image_data_url) tuples; plain strings
+    are accepted for text-only questions. Results are returned in input order.
+    """
+    sem = asyncio.Semaphore(_BATCH_CONCURRENCY)
+
+    async def _one(query):
+        user_query, image_data_url = query if isinstance(query, tuple) else (query, None)
+        async with sem:
+            return await get_chatbot_advice(user_query, image_data_url, session_id=session_id)
+
+    return await asyncio.gather(*(map(_one, queries)))
+
+
 def get_key_status():
     """Return a small, safe status dict about configured keys (masked, not full values)."""
     def _mask(key: str):
@@ -1,24 +1,131 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.middleware.gzip import GZipMiddleware
 import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-from backend import get_chatbot_advice, get_key_status
+import orjson
 
-app = FastAPI()
+from backend import get_chatbot_advice, get_key_status, close_fpl_session
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Compress sizeable responses — chat replies are several KB of text that
+# gzips well. Tiny payloads (heartbeats, status) pass through untouched.
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+
+@app.exception_handler(asyncio.TimeoutError)
+async def timeout_handler(request: Request, exc: asyncio.TimeoutError):
+    # One shared translation for provider timeouts instead of try/except in
+    # every endpoint; the path makes slow-call hunting possible from logs.
+    print(f"AI provider timeout after {CHATBOT_TIMEOUT_SECONDS}s on {request.url.path}")
+    return ORJSONResponse(
+        status_code=504,
+        content={"detail": "AI provider timed out. Try again with a smaller image or shorter message."},
+    )
+
+
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    return ORJSONResponse(status_code=500, content={"detail": str(exc)})
+
+
+@app.on_event("startup")
+async def startup_event():
+    # Bound the default executor: asyncio.to_thread (provider SDK calls, image
+    # work in backend.py) runs on it, and the stock 40-thread pool lets bursty
+    # blocking work pile up far past what the providers can absorb.
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=int(os.getenv("FPL_THREADS", "8"))))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Close the shared FPL HTTP session so pooled connections are released cleanly.
+    await close_fpl_session()
 
 templates = Jinja2Templates(directory="templates")
 
+# Serve any bundled assets directly; check_dir=False keeps startup working
+# until a static/ directory is actually added.
+app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
+
+
+@app.middleware("http")
+async def static_cache_headers(request: Request, call_next):
+    """Stamp immutable cache headers on static assets so browsers skip revalidation."""
+    response = await call_next(request)
+    if request.url.path.startswith("/static/"):
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+# Opt-in request profiling: set FPL_PROFILE=1 and append ?profile=1 to any
+# request to get a pyinstrument HTML report instead of the normal response.
+# The middleware is not even registered in normal runs, so production pays
+# nothing for it.
+if os.getenv("FPL_PROFILE") == "1":
+    from pyinstrument import Profiler
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        if not request.query_params.get("profile"):
+            return await call_next(request)
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        await call_next(request)
+        profiler.stop()
+        return HTMLResponse(profiler.output_html())
+
 
 # Maximum allowed incoming base64 image size (characters) to avoid exhausting worker memory.
 INCOMING_IMAGE_MAX_CHARS = 500_000
 
+# Configurable timeout for the AI provider call. Increase if your provider needs more time.
+CHATBOT_TIMEOUT_SECONDS = int(os.getenv("CHATBOT_TIMEOUT", "90"))
+
+# Error detail strings formatted once rather than per request.
+_IMG_TOO_LARGE_DETAIL = f'Image too large. Please resize or compress to under {INCOMING_IMAGE_MAX_CHARS} characters.'
+_PAYLOAD_TOO_LARGE_DETAIL = 'Payload too large. Please upload a smaller image (try under ~500KB) or compress it client-side.'
+
+
+def _validate_image_data_url(image_data_url):
+    """Cheap sanity checks on an image data URL before any decode work.
+
+    Rejects junk from the prefix alone — no base64 decode, no full-string
+    scan — so malformed ~500KB payloads never reach the image pipeline.
+    """
+    if not image_data_url:
+        return
+    if len(image_data_url) > INCOMING_IMAGE_MAX_CHARS:
+        raise HTTPException(status_code=413, detail=_IMG_TOO_LARGE_DETAIL)
+    # Bounded find: the media-type segment of a legitimate data URL is short,
+    # so ";base64," must appear within the first 64 chars.
+    if not image_data_url.startswith("data:image/") or image_data_url.find(";base64,", 11, 64) == -1:
+        raise HTTPException(status_code=400, detail='Invalid image data URL.')
+
+# Bound on concurrent AI advice calls per worker. Each in-flight call holds
+# provider sockets and a multi-KB prompt; a burst beyond this queues on the
+# semaphore instead of stacking up unbounded coroutines.
+MAX_INFLIGHT = int(os.getenv("FPL_MAX_INFLIGHT", "8"))
+_AI_SEM = asyncio.Semaphore(MAX_INFLIGHT)
+
+
+async def _bounded_advice(message, image_data_url, session_id):
+    """get_chatbot_advice gated by the shared concurrency semaphore."""
+    async with _AI_SEM:
+        return await get_chatbot_advice(message, image_data_url, session_id=session_id)
+
 # Also protect against overly large overall request payloads by rejecting requests early
 # when the Content-Length header indicates the body is too large. This avoids parsing huge
 # JSON bodies and gives a clear error to clients.
-# Set slightly larger than INCOMING_IMAGE_MAX_CHARS to allow for JSON wrapper overhead.
-MAX_CONTENT_LENGTH_BYTES = 700_000
+# The base64 data URL is ASCII, so its byte length equals its char length; the
+# limit is that plus a small allowance for the JSON wrapper and message text.
+MAX_CONTENT_LENGTH_BYTES = INCOMING_IMAGE_MAX_CHARS + 4096
 
 
 @app.middleware("http")
@@ -31,15 +138,22 @@ async def reject_oversized_requests(request: Request, call_next):
     try:
         content_length = request.headers.get("content-length")
         if content_length is not None:
-            # Some clients may send non-integer values; guard with a safe int conversion
-            try:
-                cl = int(content_length)
-            except Exception:
-                cl = None
-            if cl and cl > MAX_CONTENT_LENGTH_BYTES:
-                return JSONResponse(status_code=413, content={
+            # Digits-only: rejects negatives, signs and whitespace outright so
+            # pathological values never reach the body parser.
+            if not content_length.isdigit():
+                return ORJSONResponse(status_code=400, content={
+                    "error": "Invalid Content-Length header."
+                })
+            if int(content_length) > MAX_CONTENT_LENGTH_BYTES:
+                return ORJSONResponse(status_code=413, content={
                     "error": "Payload too large. Please upload a smaller image (try under ~500KB) or compress it client-side."
                 })
+        elif request.method == "POST" and request.headers.get("transfer-encoding", "").lower() != "chunked":
+            # A POST body with neither Content-Length nor chunked framing has
+            # no declared size; refuse rather than read an unbounded body.
+            return ORJSONResponse(status_code=411, content={
+                "error": "Content-Length required."
+            })
     except Exception:
         # If anything in this lightweight check fails, continue to the endpoint and let
         # existing checks handle the body safely.
@@ -48,13 +162,35 @@ async def reject_oversized_requests(request: Request, call_next):
     return await call_next(request)
 
 
+# index.html uses no template variables, so render it once at startup and
+# serve the cached bytes instead of running the TemplateResponse machinery
+# (directory lookup, env resolution, context build) per hit.
+_INDEX_HTML = templates.get_template('index.html').render().encode('utf-8')
+
+
 @app.get('/', response_class=HTMLResponse)
 async def index(request: Request):
-    return templates.TemplateResponse('index.html', {"request": request})
+    return HTMLResponse(content=_INDEX_HTML)
 
 
 @app.post('/chat')
-async def chat(payload: dict):
+async def chat(request: Request):
+    # Read and decode the body directly with orjson — the payload is three
+    # known keys, so FastAPI's dict-parameter parsing and validation machinery
+    # adds nothing but a second decode pass.
+    body = await request.body()
+    # Check the raw byte length before decoding — never allocate the parsed
+    # form of a payload that is going to be refused. Catches clients that
+    # lied about (or omitted) Content-Length past the middleware.
+    if len(body) > MAX_CONTENT_LENGTH_BYTES:
+        raise HTTPException(status_code=413, detail=_PAYLOAD_TOO_LARGE_DETAIL)
+    try:
+        payload = orjson.loads(body)
+    except Exception:
+        raise HTTPException(status_code=400, detail='Invalid JSON payload.')
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail='Invalid JSON payload.')
+
     message = payload.get('message')
     image_data_url = payload.get('image')
     session_id = payload.get('session_id')
@@ -62,25 +198,35 @@ async def chat(payload: dict):
     if not message:
         raise HTTPException(status_code=400, detail='A message is required.')
 
-    if image_data_url and len(image_data_url) > INCOMING_IMAGE_MAX_CHARS:
-        raise HTTPException(status_code=413, detail=f'Image too large. Please resize or compress to under {INCOMING_IMAGE_MAX_CHARS} characters.')
+    _validate_image_data_url(image_data_url)
 
-    # Configurable timeout for the AI provider call. Increase if your provider needs more time.
-    CHATBOT_TIMEOUT_SECONDS = 90
-    try:
-        # run the advice call with a timeout to avoid unbounded waits
-        response = await asyncio.wait_for(
-            get_chatbot_advice(message, image_data_url, session_id=session_id),
-            timeout=CHATBOT_TIMEOUT_SECONDS,
-        )
-    except asyncio.TimeoutError:
-        # Include session_id in server logs to help debugging slow calls
-        print(f"AI provider timeout after {CHATBOT_TIMEOUT_SECONDS}s for session: {session_id}")
-        raise HTTPException(status_code=504, detail='AI provider timed out. Try again with a smaller image or shorter message.')
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # run the advice call with a timeout to avoid unbounded waits. shield
+    # keeps the timeout from cancelling the call mid-flight — a cancel while
+    # a provider request is on the wire can leave its pooled connection
+    # unusable; instead the call runs to completion in the background,
+    # finishes its session bookkeeping and releases its semaphore slot, while
+    # the client still gets the 504 promptly. Timeouts and unexpected errors
+    # propagate to the registered exception handlers.
+    response = await asyncio.wait_for(
+        asyncio.shield(_bounded_advice(message, image_data_url, session_id)),
+        timeout=CHATBOT_TIMEOUT_SECONDS,
+    )
+
+    return ORJSONResponse({"response": response})
 
-    return JSONResponse({"response": response})
+
+# SSE frames that never change, encoded once at import. StreamingResponse
+# passes bytes through as-is, skipping a per-tick encode.
+HEARTBEAT_FRAME = b'data: {"type": "heartbeat", "message": "thinking"}\n\n'
+TIMEOUT_FRAME = b'data: {"type": "error", "error": "AI provider timed out"}\n\n'
+
+# Seconds of silence before a keepalive heartbeat is sent on /chat/stream.
+HEARTBEAT_INTERVAL_SECONDS = 5
+
+
+def _sse(obj):
+    """Encode one SSE data frame straight to bytes in a single pass."""
+    return b"data: " + orjson.dumps(obj) + b"\n\n"
 
 
 @app.post('/chat/stream')
@@ -91,8 +237,11 @@ async def chat_stream(request: Request):
     stream which the client can read incrementally. This implementation does not stream tokens from
     the AI provider; it sends periodic heartbeats and then the complete final message when ready.
     """
+    body = await request.body()
+    if len(body) > MAX_CONTENT_LENGTH_BYTES:
+        raise HTTPException(status_code=413, detail=_PAYLOAD_TOO_LARGE_DETAIL)
     try:
-        payload = await request.json()
+        payload = orjson.loads(body)
     except Exception:
         raise HTTPException(status_code=400, detail='Invalid JSON payload.')
 
@@ -103,72 +252,137 @@ async def chat_stream(request: Request):
     if not message:
         raise HTTPException(status_code=400, detail='A message is required.')
 
+    _validate_image_data_url(image_data_url)
+
     async def event_generator():
         # Start with an initial thinking event
-        try:
-            yield f"data: {JSONResponse({'type': 'heartbeat', 'message': 'thinking'}).body.decode()}\n\n"
-        except Exception:
-            # fallback simple text if JSONResponse didn't work as expected
-            yield "data: {\"type\": \"heartbeat\", \"message\": \"thinking\"}\n\n"
+        yield HEARTBEAT_FRAME
 
         # Run the AI call in a background task and periodically send heartbeats
         task = asyncio.create_task(
             asyncio.wait_for(
-                get_chatbot_advice(message, image_data_url, session_id=session_id),
-                timeout=90,
+                _bounded_advice(message, image_data_url, session_id),
+                timeout=CHATBOT_TIMEOUT_SECONDS,
             )
         )
 
+        # One persistent watcher drains the ASGI receive channel and flags the
+        # disconnect via an Event — no per-message task churn in the select
+        # loop, and the cancel propagates to the AI task the instant the
+        # client goes away.
+        disconnect_event = asyncio.Event()
+
+        async def _watch_disconnect():
+            while True:
+                message = await request.receive()
+                if message["type"] == "http.disconnect":
+                    disconnect_event.set()
+                    return
+
+        watcher = asyncio.create_task(_watch_disconnect())
+        disconnected = asyncio.create_task(disconnect_event.wait())
         try:
             while not task.done():
-                # send simple heartbeat so client can show progress
-                yield "data: {\"type\": \"heartbeat\", \"message\": \"thinking\"}\n\n"
-                await asyncio.sleep(1)
-                # stop if client disconnected
-                if await request.is_disconnected():
+                done, _ = await asyncio.wait(
+                    {task, disconnected},
+                    timeout=HEARTBEAT_INTERVAL_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if disconnected in done:
                     task.cancel()
                     return
+                if not done:
+                    # interval elapsed with no activity; let the client know
+                    # we're still thinking
+                    yield HEARTBEAT_FRAME
 
             # task finished — get result or exception
             try:
                 result = task.result()
-                payload_out = {"type": "message", "response": result}
-                yield f"data: {JSONResponse(payload_out).body.decode()}\n\n"
+                yield _sse({"type": "message", "response": result})
             except asyncio.TimeoutError:
-                yield "data: {\"type\": \"error\", \"error\": \"AI provider timed out\"}\n\n"
+                yield TIMEOUT_FRAME
             except Exception as e:
-                err = str(e)
-                yield f"data: {{\"type\": \"error\", \"error\": {JSONResponse({ 'error': err }).body.decode()} }}\n\n"
+                yield _sse({"type": "error", "error": str(e)})
 
         except asyncio.CancelledError:
             return
+        finally:
+            watcher.cancel()
+            disconnected.cancel()
+
+    # Explicit identity encoding keeps GZipMiddleware (and any proxy) from
+    # compressing the stream — gzip buffers output, which would hold back
+    # heartbeats; X-Accel-Buffering stops reverse proxies buffering frames.
+    return StreamingResponse(
+        event_generator(),
+        media_type='text/event-stream',
+        headers={
+            "Content-Encoding": "identity",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
 
-    return StreamingResponse(event_generator(), media_type='text/event-stream')
+
+_KEY_STATUS = None
 
 
 @app.get('/status')
 async def status():
     try:
-        status = get_key_status()
+        # Key status is constant per process (keys are read once at import),
+        # so compute it on first request and reuse the dict afterwards.
+        global _KEY_STATUS
+        if _KEY_STATUS is None:
+            _KEY_STATUS = get_key_status()
+        status = dict(_KEY_STATUS)
+        # free slots on the AI concurrency gate, for load visibility
+        status["ai_slots_free"] = _AI_SEM._value
     except Exception:
         status = {"error": "could not retrieve key status"}
-    return JSONResponse(status)
+    return ORJSONResponse(status)
+
+
+# The debug page is static; encode it to bytes once instead of per request.
+_DEBUG_HTML = b"""
+<html><head><title>Debug</title></head>
+<body style='background: #fff; color: #000; font-family: Arial, sans-serif;'>
+    <h1>Debug page</h1>
+    <p>If you see this, the server is returning HTML correctly.</p>
+    <p>Now open the browser console (Cmd+Option+J on mac) and check for errors when loading <a href="/">/</a>.</p>
+</body></html>
+"""
 
 
 @app.get('/debug', response_class=HTMLResponse)
 async def debug(request: Request):
-        """Simple debug page without JS/CSS to verify server rendering independent of templates."""
-        html = """
-        <html><head><title>Debug</title></head>
-        <body style='background: #fff; color: #000; font-family: Arial, sans-serif;'>
-            <h1>Debug page</h1>
-            <p>If you see this, the server is returning HTML correctly.</p>
-            <p>Now open the browser console (Cmd+Option+J on mac) and check for errors when loading <a href="/">/</a>.</p>
-        </body></html>
-        """
-        return HTMLResponse(content=html)
+    """Simple debug page without JS/CSS to verify server rendering independent of templates."""
+    return HTMLResponse(content=_DEBUG_HTML)
 
 
-if __name__ == '__main__':
+def run():
+    """Start the server with the tuned defaults (uvloop, httptools, no access log).
+
+    Usable as a console-script entry point (main:run) as well as via
+    ``python main.py``.
+    """
     import uvicorn
-    uvicorn.run(app, host='0.0.0.0', port=8000)
+    # Ask for the Cython-backed loop and parser explicitly so the fast path
+    # isn't silently skipped when the extras are installed. Multiple workers
+    # need the app passed as an import string; access logging off saves a
+    # formatted line per request.
+    uvicorn.run(
+        'main:app',
+        host='0.0.0.0',
+        port=int(os.getenv('PORT', '8000')),
+        workers=int(os.getenv('WEB_CONCURRENCY', '3')),
+        loop='uvloop',
+        http='httptools',
+        log_level='warning',
+        access_log=False,
+    )
+
+
+if __name__ == '__main__':
+    run()